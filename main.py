@@ -4,13 +4,27 @@ Supports streaming, downloading, and resume for large files (videos, etc.)
 Works perfectly with the Android app.
 """
 
+from contextlib import asynccontextmanager
 from datetime import datetime
+from email.utils import formatdate, parsedate_to_datetime
+from functools import lru_cache
+from operator import itemgetter
 from pathlib import Path
-from typing import List
+from typing import List, NamedTuple, Optional, Tuple
+from urllib.parse import quote
+import hashlib
 import mimetypes
+import os
+import socket
+import stat
+import sys
+import time
 
+import anyio
+import anyio.to_thread
+import orjson
 from fastapi import FastAPI, HTTPException, Request, status
-from fastapi.responses import StreamingResponse, JSONResponse
+from fastapi.responses import FileResponse, ORJSONResponse, Response, StreamingResponse
 
 # ----------------------------------------------------------------------
 # Configuration
@@ -22,51 +36,296 @@ APP_VERSION = "1.0.0"
 FILES_DIRECTORY = Path("files")
 FILES_DIRECTORY.mkdir(exist_ok=True)
 
+# Resolved media root; requested files must resolve to a path below it
+BASE_DIR = os.path.realpath(FILES_DIRECTORY)
+_BASE_PREFIX = os.path.join(BASE_DIR, "")
+
+# Number of uvicorn worker processes when started via `python main.py`
+WORKERS = os.cpu_count() or 1
+
+# Unsent-data low-water mark for client connections, and a fixed send
+# buffer size. Setting SO_SNDBUF disables TCP send-buffer autotuning, so
+# the buffer is only pinned when net.core.wmem_max allows the full size;
+# otherwise autotuning (up to tcp_wmem's max) is left alone.
+SEND_BUFFER_SIZE = 4 * 1024 * 1024
+NOTSENT_LOWAT = 128 * 1024
+
+# Seconds a directory listing is reused (and may be cached by clients)
+LISTING_TTL = 5
+
+# Size of the first chunk sent for a Range request (keeps seek latency low)
+RANGE_FIRST_CHUNK = 64 * 1024
+
+# How much of a requested range to ask the kernel to prefetch up front
+RANGE_PREFETCH = 8 * 1024 * 1024
+
+# Worker threads for blocking file I/O (per process). Keep this near the
+# disk's useful parallelism: ~8 for a spinning disk, 64 or more for NVMe.
+FILE_IO_THREADS = 8
+
+# Separate threads for directory listings, so they don't queue behind
+# file reads while videos are streaming
+LISTING_THREADS = 2
+_LISTING_LIMITER: Optional[anyio.CapacityLimiter] = None
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global _LISTING_LIMITER
+    anyio.to_thread.current_default_thread_limiter().total_tokens = FILE_IO_THREADS
+    _LISTING_LIMITER = anyio.CapacityLimiter(LISTING_THREADS)
+    yield
+
 app = FastAPI(
     title=APP_TITLE,
     version=APP_VERSION,
     description="Offline LAN media server for Android streaming app",
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan,
 )
 
 # ----------------------------------------------------------------------
 # Helper Functions
 # ----------------------------------------------------------------------
-def get_file_metadata(path: Path) -> dict:
-    """Get metadata for a file."""
-    stat = path.stat()
-    return {
-        "name": path.name,
-        "size": stat.st_size,
-        "lastModified": datetime.fromtimestamp(stat.st_mtime).isoformat(),
-    }
+# Suffix -> MIME type, built once at import instead of per request.
+# mimetypes.types_map is platform dependent, so make sure common media
+# types are always present.
+mimetypes.init()
+_CT = {
+    **mimetypes.types_map,
+    ".mp4": "video/mp4",
+    ".m4v": "video/x-m4v",
+    ".mkv": "video/x-matroska",
+    ".webm": "video/webm",
+    ".avi": "video/x-msvideo",
+    ".mov": "video/quicktime",
+    ".mp3": "audio/mpeg",
+    ".m4a": "audio/mp4",
+    ".flac": "audio/flac",
+    ".ogg": "audio/ogg",
+    ".wav": "audio/wav",
+    ".jpg": "image/jpeg",
+    ".jpeg": "image/jpeg",
+    ".png": "image/png",
+    ".pdf": "application/pdf",
+    ".txt": "text/plain",
+}
+_CT_DEFAULT = "application/octet-stream"
+
+class _Listing(NamedTuple):
+    """A directory listing together with its encoded response body."""
+    mtime_ns: int
+    built_at: float
+    files: List[dict]
+    body: bytes
+    etag: str
+    newest_ns: int
+    last_modified: str
+
+# Last listing built; reused until the directory's mtime changes or it is
+# older than LISTING_TTL
+_LIST_CACHE: Optional[_Listing] = None
+
+@lru_cache(maxsize=4096)
+def _iso(mtime_ns: int) -> str:
+    """ISO-8601 local time for a stat mtime, memoised across listings."""
+    return datetime.fromtimestamp(mtime_ns / 1e9).isoformat()
+
+def _listable_stat(entry: os.DirEntry) -> Optional[os.stat_result]:
+    """Stat result for a listable regular file, or None to skip the entry.
+
+    DirEntry caches the stat, so each file costs a single stat. Entries
+    that can't be inspected (symlink loops, permission errors, files
+    removed mid-scan) are skipped like Path.is_file() used to.
+    """
+    try:
+        if not entry.is_file():
+            return None
+        # Same rule as get_file: symlinks must resolve inside the root
+        if entry.is_symlink() and not os.path.realpath(entry.path).startswith(_BASE_PREFIX):
+            return None
+        return entry.stat()
+    except OSError:
+        return None
 
-def list_media_files() -> List[dict]:
-    """List all media files in the root directory."""
+def get_listing() -> _Listing:
+    """Return the cached listing of the root directory.
+
+    The listing is rebuilt when the directory's mtime changes (a file was
+    added, removed or renamed) or after LISTING_TTL seconds, since writes
+    into an existing file don't touch the directory's mtime. Its JSON
+    body is encoded once per rebuild.
+    """
+    global _LIST_CACHE
+    dir_mtime = FILES_DIRECTORY.stat().st_mtime_ns
+    now = time.monotonic()
+    if (
+        _LIST_CACHE is not None
+        and _LIST_CACHE.mtime_ns == dir_mtime
+        and now - _LIST_CACHE.built_at < LISTING_TTL
+    ):
+        return _LIST_CACHE
+
+    # Sort (lowered name, entry, stat) rows before building the dicts
+    rows = []
+    with os.scandir(FILES_DIRECTORY) as it:
+        for entry in it:
+            if entry.name.startswith("."):
+                continue
+            st = _listable_stat(entry)
+            if st is not None:
+                rows.append((entry.name.lower(), entry, st))
+    rows.sort(key=itemgetter(0))
     files = []
-    for item in FILES_DIRECTORY.iterdir():
-        if item.is_file() and not item.name.startswith("."):
-            files.append(get_file_metadata(item))
-    files.sort(key=lambda x: x["name"].lower())
-    return files
-
-def stream_full_file(file_path: Path, chunk_size: int = 1024 * 1024):
-    """Stream the entire file."""
-    with open(file_path, "rb") as f:
-        while chunk := f.read(chunk_size):
-            yield chunk
+    newest = dir_mtime
+    for _, entry, st in rows:
+        newest = max(newest, st.st_mtime_ns)
+        files.append({
+            "name": entry.name,
+            "size": st.st_size,
+            "lastModified": _iso(st.st_mtime_ns),
+        })
+    # ETag follows the body, so a file growing in place changes it too
+    body = orjson.dumps(files)
+    etag = f'"{hashlib.blake2b(body, digest_size=8).hexdigest()}"'
+    _LIST_CACHE = _Listing(
+        dir_mtime, now, files, body, etag, newest, http_date(newest)
+    )
+    return _LIST_CACHE
+
+def count_media_files() -> int:
+    """Number of media files in the root directory (uses the listing cache)."""
+    return len(get_listing().files)
+
+def http_date(mtime_ns: int) -> str:
+    """Format a stat mtime as an HTTP-date for Last-Modified."""
+    return formatdate(mtime_ns / 1e9, usegmt=True)
+
+def content_disposition(disposition: str, name: str) -> str:
+    """Content-Disposition value encoded the same way FileResponse does it.
+
+    Names that aren't plain URL-safe text (non-ASCII, quotes, ...) are sent
+    as RFC 5987 ``filename*=utf-8''...`` so the header stays valid.
+    """
+    quoted = quote(name)
+    if quoted != name:
+        return f"{disposition}; filename*=utf-8''{quoted}"
+    return f'{disposition}; filename="{name}"'
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Weak comparison of an If-None-Match header against ``etag``."""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    etag = etag.removeprefix("W/")
+    return any(tag.strip().removeprefix("W/") == etag for tag in if_none_match.split(","))
+
+def is_not_modified(request: Request, etag: str, mtime_ns: int) -> bool:
+    """Whether a conditional GET/HEAD can be answered with 304.
+
+    If-None-Match takes precedence; If-Modified-Since is only consulted
+    when it is absent (RFC 9110 section 13.2.2).
+    """
+    if_none_match = request.headers.get("If-None-Match")
+    if if_none_match is not None:
+        return etag_matches(if_none_match, etag)
+
+    if_modified_since = request.headers.get("If-Modified-Since")
+    if not if_modified_since:
+        return False
+    try:
+        since = parsedate_to_datetime(if_modified_since).timestamp()
+    except (TypeError, ValueError):
+        return False
+    # HTTP dates have one-second resolution
+    return mtime_ns // 1_000_000_000 <= since
+
+# Any offset with more significant digits than this exceeds int64 and
+# every real file
+_MAX_OFFSET_DIGITS = 19
+
+def _clamped_offset(digits: str, limit: int) -> int:
+    """``min(int(digits), limit)`` for a validated ASCII digit string.
+
+    Overlong values are clamped without calling int(), which keeps the
+    parse cost bounded and avoids int()'s max-digits ValueError. Leading
+    zeros don't count towards the length.
+    """
+    digits = digits.lstrip("0")
+    if len(digits) > _MAX_OFFSET_DIGITS:
+        return limit
+    return min(int(digits or "0"), limit)
+
+def parse_range(range_header: str, file_size: int) -> Tuple[int, int]:
+    """Parse a single "bytes=start-end" Range header into inclusive offsets.
 
-def stream_range(file_path: Path, start: int, end: int, chunk_size: int = 8192):
-    """Stream a byte range from the file."""
-    with open(file_path, "rb") as f:
+    Raises 400 for a malformed header and 416 when the range lies outside
+    the file.
+    """
+    if not range_header.startswith("bytes="):
+        raise HTTPException(status_code=400, detail="Malformed Range header")
+
+    start_str, dash, end_str = range_header[6:].strip().partition("-")
+    if (
+        not dash
+        or not (start_str or end_str)
+        or not (start_str.isascii() and end_str.isascii())
+        or (start_str and not start_str.isdigit())
+        or (end_str and not end_str.isdigit())
+    ):
+        raise HTTPException(status_code=400, detail="Malformed Range header")
+
+    if not start_str:
+        # Suffix range "bytes=-N": the last N bytes
+        start = file_size - _clamped_offset(end_str, file_size)
+        end = file_size - 1
+    else:
+        start = _clamped_offset(start_str, file_size)
+        end = _clamped_offset(end_str, file_size - 1) if end_str else file_size - 1
+
+    if start >= file_size or end < start:
+        raise HTTPException(status_code=416, detail="Range not satisfiable")
+    return start, end
+
+def _open_range(file_path: str, start: int, length: int):
+    """Open ``file_path`` positioned at ``start`` with readahead hints.
+
+    On POSIX the kernel is told the range will be read sequentially and
+    asked to start prefetching it before the first read.
+    """
+    f = open(file_path, "rb")
+    try:
         f.seek(start)
-        remaining = end - start + 1
+    except BaseException:
+        f.close()
+        raise
+    if hasattr(os, "posix_fadvise"):
+        try:
+            fd = f.fileno()
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            os.posix_fadvise(fd, start, min(length, RANGE_PREFETCH), os.POSIX_FADV_WILLNEED)
+        except OSError:
+            pass  # hints only; some filesystems reject them
+    return f
+
+async def stream_range(file_path: str, start: int, end: int, chunk_size: int = 1024 * 1024):
+    """Stream a byte range from the file.
+
+    Reads run in anyio's worker threads so a slow disk does not stall the
+    event loop. The first chunk is small so players get bytes quickly
+    after a seek; chunk size then doubles up to ``chunk_size``.
+    """
+    read_size = min(RANGE_FIRST_CHUNK, chunk_size)
+    remaining = end - start + 1
+    raw = await anyio.to_thread.run_sync(_open_range, file_path, start, remaining)
+    async with anyio.AsyncFile(raw) as f:
         while remaining > 0:
-            read_size = min(chunk_size, remaining)
-            chunk = f.read(read_size)
+            chunk = await f.read(min(read_size, remaining))
             if not chunk:
                 break
             remaining -= len(chunk)
             yield chunk
+            read_size = min(read_size * 2, chunk_size)
 
 # ----------------------------------------------------------------------
 # API Endpoints
@@ -77,100 +336,160 @@ async def root():
         "message": "LAN Media Server is running",
         "title": APP_TITLE,
         "version": APP_VERSION,
-        "files_count": len(list_media_files()),
+        "files_count": await anyio.to_thread.run_sync(
+            count_media_files, limiter=_LISTING_LIMITER
+        ),
     }
 
 @app.get("/api/files")
-async def get_file_list():
+async def get_file_list(request: Request):
     """Return list of all files in the media folder."""
     try:
-        return JSONResponse(content=list_media_files())
+        listing = await anyio.to_thread.run_sync(get_listing, limiter=_LISTING_LIMITER)
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"Failed to list files: {str(e)}"
         )
 
+    headers = {
+        "ETag": listing.etag,
+        "Last-Modified": listing.last_modified,
+        "Cache-Control": f"max-age={LISTING_TTL}",
+    }
+    if is_not_modified(request, listing.etag, listing.newest_ns):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return Response(listing.body, media_type="application/json", headers=headers)
+
 @app.get("/api/files/{filename:path}")
+@app.head("/api/files/{filename:path}")
 async def get_file(filename: str, request: Request, download: bool = False):
     """Stream or download a file with resume support."""
-    # Security: prevent path traversal
-    if ".." in filename or filename.startswith("/"):
+    # Security: prevent path traversal. Resolving the target also catches
+    # absolute paths, backslashes on Windows and symlinks leading outside.
+    # Plain strings and os.path avoid building Path objects per request.
+    try:
+        file_path = os.path.realpath(os.path.join(BASE_DIR, filename))
+    except ValueError:  # embedded NUL byte
+        raise HTTPException(status_code=400, detail="Invalid filename")
+    if not file_path.startswith(_BASE_PREFIX):
         raise HTTPException(status_code=400, detail="Invalid filename")
 
-    file_path = FILES_DIRECTORY / filename
+    name = os.path.basename(file_path)
 
-    if not file_path.is_file():
+    # One stat serves the existence check, the size and FileResponse
+    try:
+        st = os.stat(file_path)
+    except OSError:  # missing, symlink loop, unreadable: as os.path.isfile
+        raise HTTPException(status_code=404, detail="File not found")
+    if not stat.S_ISREG(st.st_mode):
         raise HTTPException(status_code=404, detail="File not found")
 
-    file_size = file_path.stat().st_size
+    file_size = st.st_size
 
-    # Guess MIME type
-    media_type, _ = mimetypes.guess_type(file_path.name)
-    media_type = media_type or "application/octet-stream"
+    media_type = _CT.get(os.path.splitext(name)[1].lower(), _CT_DEFAULT)
 
     disposition = "attachment" if download else "inline"
 
     base_headers = {
         "Accept-Ranges": "bytes",
-        "Content-Disposition": f'{disposition}; filename="{file_path.name}"',
+        "ETag": f'W/"{file_size:x}-{st.st_mtime_ns:x}"',
+        "Last-Modified": http_date(st.st_mtime_ns),
     }
 
-    range_header = request.headers.get("Range")
+    # Client already has this version; answer from the stat alone
+    if is_not_modified(request, base_headers["ETag"], st.st_mtime_ns):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=base_headers)
 
-    if range_header:
-        # Parse Range header: "bytes=0-" or "bytes=12345-"
-        try:
-            if not range_header.startswith("bytes="):
-                raise ValueError("Invalid unit")
-
-            range_str = range_header[6:].strip()
-            start_str, end_str = (range_str.split("-") + [""])[:2]
+    # HEAD only needs the headers; don't open the file at all
+    if request.method == "HEAD":
+        return Response(
+            headers={
+                **base_headers,
+                "Content-Disposition": content_disposition(disposition, name),
+                "Content-Length": str(file_size),
+            },
+            media_type=media_type,
+        )
 
-            start = int(start_str) if start_str else 0
-            end = int(end_str) if end_str else file_size - 1
+    range_header = request.headers.get("Range")
 
-            if start >= file_size or start < 0 or (end_str and end < start):
-                raise HTTPException(status_code=416, detail="Range not satisfiable")
+    if range_header:
+        start, end = parse_range(range_header, file_size)
 
-            length = end - start + 1
+        headers = {
+            **base_headers,
+            "Content-Disposition": content_disposition(disposition, name),
+            "Content-Range": f"bytes {start}-{end}/{file_size}",
+            "Content-Length": str(end - start + 1),
+        }
 
-            headers = {
-                **base_headers,
-                "Content-Range": f"bytes {start}-{end}/{file_size}",
-                "Content-Length": str(length),
-            }
-
-            return StreamingResponse(
-                stream_range(file_path, start, end),
-                status_code=206,  # Partial Content
-                headers=headers,
-                media_type=media_type,
-            )
-        except ValueError:
-            raise HTTPException(status_code=400, detail="Malformed Range header")
-        except Exception as e:
-            raise HTTPException(status_code=416, detail=f"Range error: {str(e)}")
-
-    # Full file download (no Range header)
-    headers = {
-        **base_headers,
-        "Content-Length": str(file_size),
-    }
+        return StreamingResponse(
+            stream_range(file_path, start, end),
+            status_code=206,  # Partial Content
+            headers=headers,
+            media_type=media_type,
+        )
 
-    return StreamingResponse(
-        stream_full_file(file_path),
-        status_code=200,
-        headers=headers,
+    # Full file download (no Range header): FileResponse sets Content-Length
+    # and lets the server hand the file off without a Python generator
+    return FileResponse(
+        file_path,
+        headers=base_headers,
         media_type=media_type,
+        filename=name,
+        stat_result=st,
+        content_disposition_type=disposition,
     )
 
 # ----------------------------------------------------------------------
 # Run Server
 # ----------------------------------------------------------------------
+def _wmem_max() -> int:
+    """net.core.wmem_max, or 0 when it can't be read (non-Linux)."""
+    try:
+        with open("/proc/sys/net/core/wmem_max") as f:
+            return int(f.read())
+    except (OSError, ValueError):
+        return 0
+
+def bind_listen_socket(host: str, port: int) -> socket.socket:
+    """Bind the server socket with send-buffer tuning for large responses.
+
+    Accepted connections inherit these options from the listening socket.
+    SO_SNDBUF is only set when net.core.wmem_max is at least
+    SEND_BUFFER_SIZE; a smaller cap would lock the buffer below what
+    autotuning reaches on its own.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if _wmem_max() >= SEND_BUFFER_SIZE:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SEND_BUFFER_SIZE)
+    if hasattr(socket, "TCP_NOTSENT_LOWAT"):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NOTSENT_LOWAT, NOTSENT_LOWAT)
+    sock.bind((host, port))
+    sock.set_inheritable(True)
+    return sock
+
 if __name__ == "__main__":
     import uvicorn
     print(f"{APP_TITLE} v{APP_VERSION} starting...")
     print(f"Serving files from: {FILES_DIRECTORY.resolve()}")
     print("Access from LAN devices: http://YOUR_PC_IP:8000")
-    uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=True)
\ No newline at end of file
+    print(f"Workers: {WORKERS}")
+    if sys.platform == "win32":
+        # uvicorn cannot serve from a pre-bound fd on Windows
+        bind = {"host": "0.0.0.0", "port": 8000}
+    else:
+        listen_sock = bind_listen_socket("0.0.0.0", 8000)
+        bind = {"fd": listen_sock.fileno()}
+    uvicorn.run(
+        "main:app",
+        **bind,
+        # uvloop has no Windows build; uvicorn[standard] skips it there
+        loop="asyncio" if sys.platform == "win32" else "uvloop",
+        http="httptools",
+        # One process per core; reload cannot be combined with workers
+        workers=WORKERS,
+        reload=False,
+    )